@@ -4,10 +4,22 @@ import sys
 import io
 import asyncio
 import logging
+import logging.handlers
+import queue
+import threading
+import time
+import weakref
 import signal
 import hashlib
+import zlib
+import struct
+import ast
 import datetime
 import argparse
+import fnmatch
+import random
+import concurrent.futures
+from collections import Counter, OrderedDict
 from enum import Enum
 from pathlib import Path
 import contextlib
@@ -17,6 +29,7 @@ import aiofiles
 import aiofiles.os
 import aioboto3
 import asyncpg
+from botocore.exceptions import ClientError
 
 config = {
     'db_endpoint': 'postgresql://postgres@127.0.0.1/bus3',
@@ -30,15 +43,36 @@ config = {
     'restore_max': 256,  # max concurrent restore tasks
     'db_timeout': 180,  # timeout value
     'db_password': 'bus3pass',
+    'dir_cache_size': 4096,  # max number of cached directory listings
+    'xattr_cache_size': 4096,  # max number of cached xattr sets
+    'hash_workers': os.cpu_count(),  # threads to calculate hash in (verify)
+    'catalog_export': True,  # export database to S3 after each backup
+    'catalog_prefix': 'bus3-catalog/',  # S3 key prefix of database exports
+    'catalog_compress_level': 1,  # zlib level for database exports
+    'catalog_timeout': 24*3600,  # timeout for database export/import
+    'log_sample_rate': 10,  # max per file messages per second per message
+    'profile_interval': 0.005,  # seconds between profile samples
     # global temp variables from here:
     'scan_counter': 1,  # initial value
     'root_dir': None,  # backup root directory (will be overwritten)
     'large_buffers': 0,  # Number of large buffers (up to chunksize) being used
-    'runmode': 0,  # 0: list history, 1: backup, 2: restore, 3: restore database
+    'runmode': 0,  # RunMode
     'dbrestore_rel': 0,  # relative number from latest backed-up database file
     'restore_target': None,  # file or folder to restore
     'restore_to': None,  # restore to directory
     'restore_version': 0,  # optional restore version
+    'browse_path': '',  # directory to list or file to show history of
+    'browse_version': 0,  # scan counter to browse (0: latest)
+    'find_pattern': None,  # name glob to find
+    'find_min_size': None,  # find files at least this size
+    'find_max_size': None,  # find files at most this size
+    'find_newer': None,  # find files modified at or after this time
+    'find_older': None,  # find files modified before this time
+    'keep_last': 0,  # gc: keep the last N scans
+    'keep_daily': 0,  # gc: keep the latest scan of each of the last N days
+    'keep_weekly': 0,  # gc: keep the latest scan of each of the last N weeks
+    'verify_sample': 1.0,  # fraction of objects to verify
+    'verify_head_only': False,  # verify: compare object sizes only
     'num_tasks': 0,  # number of tasks
     'processed_files': 0,  # number of processed files
     'processed_size': 0,  # total size of processed files
@@ -46,17 +80,92 @@ config = {
     'end_time': 0,
     'db_pool': None,  # database connection pool
     's3_pool': [],  # S3 client pool
+    's3_clients': 0,  # number of S3 clients created for the pool
 }
 processing_db = []  # list of paths to files/dirs
 processing_s3 = []  # list of paths to files
 task_list = []  # task list
 hardlink_dict = {}  # dict of hard links (fsid, inode): <path> or None
+hardlink_lock = asyncio.Lock()  # serializes files with hard links
+dir_cache = OrderedDict()  # LRU cache of (dirent_id, scan_counter): children
+xattr_cache = OrderedDict()  # LRU cache of xattr hash: xattr_set id
+task_started = weakref.WeakKeyDictionary()  # task: creation time
+task_waiting = weakref.WeakKeyDictionary()  # task: (await point, first seen)
+CATALOG_LOCK = 0x62757333  # advisory lock key ('bus3')
+# database tables to export; tables referenced by foreign keys come first
+CATALOG_LEVELS = (('dirent', 'xattr_set', 'scan'), ('version',), ('ver_object',))
+
+# per-subsystem loggers; per file/chunk messages are logged at DEBUG
+backup_log = logging.getLogger('bus3.backup')
+restore_log = logging.getLogger('bus3.restore')
+s3_log = logging.getLogger('bus3.s3')
+
+
+class LogSampler(logging.Filter):
+    """
+    Rate-limit log records to 'rate' per second for each message format
+    and note how many were suppressed in the next record let through
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.windows = {}  # msg: [window start, records, suppressed]
+
+    def filter(self, record):
+        now = int(record.created)
+        window = self.windows.setdefault(record.msg, [now, 0, 0])
+        if window[0] != now:
+            window[0], window[1] = now, 0
+        window[1] += 1
+        if window[1] > self.rate:
+            window[2] += 1
+            return False
+        if window[2]:
+            record.msg = f"{record.msg} ({window[2]} similar messages suppressed)"
+            window[2] = 0
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves formatting to the listener thread
+    """
+
+    def prepare(self, record):
+        return record
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s,%(msecs)d %(levelname)s: %(message)s",
-    datefmt="%H:%M:%S",
-)
+
+def setup_logging(levels, debug):
+    """
+    Send log records through a queue to a background thread
+
+    Args:
+        levels: dict of logger name: level name or number
+                (eg, {'bus3.s3': 'DEBUG'} or {'bus3.s3': 10})
+        debug: True to log per file/chunk messages of all subsystems
+    Return:
+        QueueListener to stop at exit
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s,%(msecs)d %(levelname)s: %(message)s",
+        datefmt="%H:%M:%S"))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(LazyQueueHandler(log_queue))
+    for logger in (backup_log, restore_log, s3_log):
+        logger.addFilter(LogSampler(config['log_sample_rate']))
+        if debug:
+            logger.setLevel(logging.DEBUG)
+    for name, level in levels.items():
+        if isinstance(level, str):  # level name; numbers are taken as is
+            level = level.upper()
+        logging.getLogger(name).setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
 
 
 class Kind(Enum):
@@ -64,7 +173,67 @@ class Kind(Enum):
 
 
 class RunMode(Enum):
-    LIST_HISTORY, BACKUP, RESTORE, RESTORE_DB = range(4)
+    LIST_HISTORY, BACKUP, RESTORE, RESTORE_DB, LIST_DIR, FIND, FILE_HISTORY, \
+        GC, VERIFY = range(9)
+
+
+def encode_xattrs(path):
+    """
+    Read extended attributes of a file and encode them
+    Return:
+        bytes (empty if no xattr); for each attribute sorted by name,
+        name length (2 bytes), value length (4 bytes), name and value
+    """
+    data = bytearray()
+    for name in sorted(os.listxattr(path, follow_symlinks=False)):
+        value = os.getxattr(path, name, follow_symlinks=False)
+        bname = os.fsencode(name)
+        data += struct.pack('>HI', len(bname), len(value)) + bname + value
+    return bytes(data)
+
+
+def decode_xattrs(data):
+    """
+    Decode extended attributes encoded by encode_xattrs()
+    Return:
+        list of (name, value)
+    """
+    xattrs = []
+    pos = 0
+    while pos < len(data):
+        name_len, value_len = struct.unpack_from('>HI', data, pos)
+        pos += 6
+        name = os.fsdecode(data[pos:pos+name_len])
+        pos += name_len
+        xattrs.append((name, data[pos:pos+value_len]))
+        pos += value_len
+    return xattrs
+
+
+async def get_xattr_id(db, data):
+    """
+    Look up or insert encoded extended attributes in xattr_set table
+    Most files share identical attribute sets (eg, SELinux labels)
+    so each distinct set is stored once.
+    Return:
+        xattr_set id or None if no xattr
+    """
+    if not data:
+        return None
+    digest = hashlib.sha256(data).digest()
+    if digest in xattr_cache:
+        xattr_cache.move_to_end(digest)
+        return xattr_cache[digest]
+    xattr_id = await db.fetchval(
+        "WITH ins AS (INSERT INTO xattr_set (hash, data) VALUES ($1, $2) ON CONFLICT (hash) DO NOTHING RETURNING id) SELECT id FROM ins UNION ALL SELECT id FROM xattr_set WHERE hash=$1 LIMIT 1",
+        digest, data)
+    if xattr_id is None:  # inserted by a concurrent task
+        xattr_id = await db.fetchval(
+            "SELECT id FROM xattr_set WHERE hash=$1", digest)
+    xattr_cache[digest] = xattr_id
+    if len(xattr_cache) > config['xattr_cache_size']:
+        xattr_cache.popitem(last=False)
+    return xattr_id
 
 
 async def set_dirent_version(path, parent, fsid, stat, kind):
@@ -72,73 +241,75 @@ async def set_dirent_version(path, parent, fsid, stat, kind):
     Set dirent and version tables
     Return:
         dirent_row_id: dirent id
-        version_row_id: version id if created.  -1 if not
+        version_row_id: version id if created.  latest version id if not
         contents_changed: True if file contents changed
         is_hardlink: True if it's a hard link
     """
-    async with config['db_pool'].acquire() as db:
-
-        is_hardlink = False  # hard link flag
-        # dirent table
-        dirent_row = await db.fetchrow(
-            "SELECT * FROM dirent WHERE fsid=$1 AND inode=$2",
-            fsid, stat.st_ino)
-        if not dirent_row:
-            dirent_row_id = await db.fetchval(
-                "INSERT INTO dirent (is_deleted, type, fsid, inode, scan_counter) VALUES (0, $1, $2, $3, $4) RETURNING id",
-                kind.name, fsid, stat.st_ino, config['scan_counter'])
-        else:
-            dirent_row_id = dirent_row[0]
-            if dirent_row[5] == config['scan_counter']:
-                is_hardlink = True
+    # names of a hard link are processed concurrently; serialize them so
+    # that they share one dirent
+    locked = kind != Kind.DIRECTORY and stat.st_nlink > 1
+    if locked:
+        await hardlink_lock.acquire()
+    try:
+        async with config['db_pool'].acquire() as db:
+
+            is_hardlink = False  # hard link flag
+            # dirent table
+            dirent_row = await db.fetchrow(
+                "SELECT * FROM dirent WHERE fsid=$1 AND inode=$2",
+                fsid, stat.st_ino)
+            if not dirent_row:
+                dirent_row_id = await db.fetchval(
+                    "INSERT INTO dirent (is_deleted, type, fsid, inode, scan_counter) VALUES (0, $1, $2, $3, $4) RETURNING id",
+                    kind.name, fsid, stat.st_ino, config['scan_counter'])
             else:
-                await db.execute(
-                    "UPDATE dirent SET is_deleted = 0, scan_counter = $1 WHERE id = $2",
-                    config['scan_counter'], dirent_row_id)
-
-        # version table
-        version_row_id = -1
-        contents_changed = False
-        link_path = ""
-        if kind == Kind.SYMLINK:
-            link_path = os.readlink(path)
-        version_row = await db.fetchrow(
-            "SELECT * FROM version WHERE dirent_id=$1 ORDER BY id DESC",
-            dirent_row_id)
-        if not version_row or is_hardlink:
-            xattrdic = {}
-            names = os.listxattr(path, follow_symlinks=False)
-            for name in names:
-                xattrdic[name] = os.getxattr(path, name, follow_symlinks=False)
-            version_row_id = await db.fetchval(
-                "INSERT INTO version (is_delmarker, name, size, ctime, mtime, atime, permission, uid, gid, link_path, xattr, dirent_id, scan_counter, parent_id, is_hardlink) VALUES (0, $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14) RETURNING id",
-                os.path.basename(path), stat.st_size,
-                datetime.datetime.fromtimestamp(stat.st_ctime),
-                datetime.datetime.fromtimestamp(stat.st_mtime),
-                datetime.datetime.fromtimestamp(stat.st_atime),
-                stat.st_mode, stat.st_uid, stat.st_gid, link_path,
-                str(xattrdic), dirent_row_id,
-                config['scan_counter'], parent, is_hardlink)
-            contents_changed = True
-        elif version_row[4] != datetime.datetime.fromtimestamp(stat.st_ctime) \
-                or version_row[5] != datetime.datetime.fromtimestamp(stat.st_mtime):
-            xattrdic = {}
-            names = os.listxattr(path, follow_symlinks=False)
-            for name in names:
-                xattrdic[name] = os.getxattr(path, name, follow_symlinks=False)
-            version_row_id = await db.fetchval(
-                "INSERT INTO version (is_delmarker, name, size, ctime, mtime, atime, permission, uid, gid, link_path, xattr, dirent_id, scan_counter, parent_id, is_hardlink) VALUES (0, $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14) RETURNING id",
-                os.path.basename(path), stat.st_size,
-                datetime.datetime.fromtimestamp(stat.st_ctime),
-                datetime.datetime.fromtimestamp(stat.st_mtime),
-                datetime.datetime.fromtimestamp(stat.st_atime),
-                stat.st_mode, stat.st_uid, stat.st_gid, link_path,
-                str(xattrdic), dirent_row_id,
-                config['scan_counter'], parent, is_hardlink)
-            if version_row[5] != stat.st_mtime:  # contents changed?
+                dirent_row_id = dirent_row[0]
+                if dirent_row[5] == config['scan_counter']:
+                    is_hardlink = True
+                else:
+                    await db.execute(
+                        "UPDATE dirent SET is_deleted = 0, scan_counter = $1 WHERE id = $2",
+                        config['scan_counter'], dirent_row_id)
+
+            # version table
+            contents_changed = False
+            link_path = ""
+            if kind == Kind.SYMLINK:
+                link_path = os.readlink(path)
+
+            async def insert_version():
+                xattr_id = await get_xattr_id(db, encode_xattrs(path))
+                return await db.fetchval(
+                    "INSERT INTO version (is_delmarker, name, size, ctime, mtime, atime, permission, uid, gid, link_path, xattr_id, dirent_id, scan_counter, parent_id, is_hardlink) VALUES (0, $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14) RETURNING id",
+                    os.path.basename(path), stat.st_size,
+                    datetime.datetime.fromtimestamp(stat.st_ctime),
+                    datetime.datetime.fromtimestamp(stat.st_mtime),
+                    datetime.datetime.fromtimestamp(stat.st_atime),
+                    stat.st_mode, stat.st_uid, stat.st_gid, link_path,
+                    xattr_id, dirent_row_id,
+                    config['scan_counter'], parent, is_hardlink)
+
+            version_row = await db.fetchrow(
+                "SELECT * FROM version WHERE dirent_id=$1 ORDER BY id DESC",
+                dirent_row_id)
+            # a delete marker means it has come back (eg, same inode reused)
+            if not version_row or is_hardlink or version_row[1] == 1:
+                version_row_id = await insert_version()
                 contents_changed = True
-        if is_hardlink:
-            await db.execute("UPDATE version SET is_hardlink=True WHERE dirent_id=$1", dirent_row_id)
+            elif version_row[4] != datetime.datetime.fromtimestamp(stat.st_ctime) \
+                    or version_row[5] != datetime.datetime.fromtimestamp(stat.st_mtime):
+                version_row_id = await insert_version()
+                if version_row[5] != stat.st_mtime:  # contents changed?
+                    contents_changed = True
+            elif version_row[15]:  # record every name of a hard link each scan
+                version_row_id = await insert_version()
+            else:  # unchanged; children still point to the latest version
+                version_row_id = version_row[0]
+            if is_hardlink:
+                await db.execute("UPDATE version SET is_hardlink=True WHERE dirent_id=$1", dirent_row_id)
+    finally:
+        if locked:
+            hardlink_lock.release()
     return dirent_row_id, version_row_id, contents_changed, is_hardlink
 
 
@@ -172,7 +343,8 @@ async def write_to_s3(chunk_index, file_path, object_hash, size, contents):
     while config['large_buffers'] >= config['lb_max']:
         await asyncio.sleep(1)
     config['large_buffers'] += 1
-    logging.info(f"Grab a large buffer: {size} for {file_path}:{chunk_index}")
+    s3_log.debug("Grab a large buffer: %d for %s:%d",
+                 size, file_path, chunk_index)
     large_buffer = bytearray(size)
     view = memoryview(large_buffer)
     async with aiofiles.open(file_path, mode='rb') as f:
@@ -185,8 +357,8 @@ async def write_to_s3(chunk_index, file_path, object_hash, size, contents):
     config['large_buffers'] -= 1
     config['s3_pool'].append(s3)  # put S3 client back to pool
     processing_s3.remove(file_path)
-    logging.info(
-        f"Done chunk s3 write: {file_path}:{chunk_index} (db:{len(processing_db)},s3:{len(processing_s3)})")
+    s3_log.debug("Done chunk s3 write: %s:%d (db:%d,s3:%d)", file_path,
+                 chunk_index, len(processing_db), len(processing_s3))
     config['num_tasks'] -= 1
 
 
@@ -200,14 +372,14 @@ async def process_file(path, parent, fsid, islink):
         islink: True if symbolic link
     """
     processing_db.append(path)
-    logging.info(
-        f"Processing file started: (db:{len(processing_db)},s3:{len(processing_s3)})")
+    backup_log.debug("Processing file started: (db:%d,s3:%d)",
+                     len(processing_db), len(processing_s3))
     stat = await aiofiles.os.stat(path, follow_symlinks=False)
     if islink:  # symbolic link
         await set_dirent_version(path, parent, fsid, stat, Kind.SYMLINK)
         processing_db.remove(path)
-        logging.info(f"Processed symlink: {path}")
-        cofnfig['num_tasks'] -= 1
+        backup_log.debug("Processed symlink: %s", path)
+        config['num_tasks'] -= 1
         return
 
     version_row_id, contents_changed = 1, True
@@ -215,7 +387,7 @@ async def process_file(path, parent, fsid, islink):
         await set_dirent_version(path, parent, fsid, stat, Kind.FILE)
     if not contents_changed or is_hardlink:  # no update to file contents?
         if is_hardlink:
-            logging.info(f"hard link for file: {path}")
+            backup_log.debug("hard link for file: %s", path)
         processing_db.remove(path)
         config['num_tasks'] -= 1
         return
@@ -229,7 +401,7 @@ async def process_file(path, parent, fsid, islink):
             hash_val = hashlib.sha256()
             size = 0
             contents = prev_contents = b''
-            logging.info(f"Calc hash started: {path}:{chunk_index}")
+            backup_log.debug("Calc hash started: %s:%d", path, chunk_index)
             while size < chunksize:  # calculate hash for the file or up to chunk size
                 contents = await f.read(bufsize)
                 size += len(contents)
@@ -238,18 +410,19 @@ async def process_file(path, parent, fsid, islink):
                     break
                 hash_val.update(contents)
                 prev_contents = contents
-            logging.info(f"Calc hash end: {path}:{chunk_index}")
+            backup_log.debug("Calc hash end: %s:%d", path, chunk_index)
             object_hash = hash_val.hexdigest()
             async with config['db_pool'].acquire() as db:
                 ver_object_row = await db.fetchrow("SELECT * FROM ver_object WHERE object_hash=$1", object_hash)
                 # find an ver_object_row -> same content object is in S3
-                if not ver_object_row and size != 0:
+                # every version references its objects for garbage collection
+                if size != 0:
                     await db.execute(
                         "INSERT INTO ver_object (ver_id, object_hash) VALUES ($1, $2)",
                         version_row_id, object_hash)
             if not ver_object_row and size != 0:
                 config['num_tasks'] += 1
-                logging.info(f"Invoke S3 write - {path}:{chunk_index}")
+                backup_log.debug("Invoke S3 write - %s:%d", path, chunk_index)
                 task = asyncio.create_task(
                     write_to_s3(chunk_index, path, object_hash, size,
                                 prev_contents))
@@ -258,8 +431,8 @@ async def process_file(path, parent, fsid, islink):
                 break
             chunk_index += 1
     processing_db.remove(path)
-    logging.info(
-        f"Processed file: (db:{len(processing_db)},s3:{len(processing_s3)})")
+    backup_log.debug("Processed file: (db:%d,s3:%d)",
+                     len(processing_db), len(processing_s3))
     config['processed_files'] += 1
     config['processed_size'] += stat.st_size
     config['num_tasks'] -= 1
@@ -280,7 +453,7 @@ async def process_dir(path, parent):
         await set_dirent_version(path, parent, fsid, stat, Kind.DIRECTORY)
     processing_db.remove(path)
     if is_hardlink:
-        logging.info(f"hard link for dir: {path}")
+        backup_log.debug("hard link for dir: %s", path)
         config['num_tasks'] -= 1
         return
 
@@ -306,8 +479,8 @@ async def process_dir(path, parent):
                 process_file(dent.path, version_row_id, fsid, True))
             task_list.append(task)
         else:
-            logging.info(f"Not file or dir: {dent.path}  Skipped")
-    logging.info(f"Processed dir: {path}")
+            backup_log.info("Not file or dir: %s  Skipped", dent.path)
+    backup_log.debug("Processed dir: %s", path)
     config['num_tasks'] -= 1
 
 
@@ -322,6 +495,108 @@ async def shutdown(signal, loop):
     loop.stop()
 
 
+def await_point(task):
+    """
+    Return where a task is waiting; chain of coroutine frames from the
+    task down to the innermost one and the future it awaits if any
+    """
+    coro = task.get_coro()
+    points = []
+    awaiting = None
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) \
+            or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        points.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        awaiting = getattr(coro, 'cr_await', None) \
+            or getattr(coro, 'gi_yieldfrom', None)
+        coro = awaiting
+    if not points:
+        return repr(task.get_coro())
+    point = ' > '.join(points)
+    if awaiting is not None and not hasattr(awaiting, 'cr_frame'):
+        point += f" awaiting {type(awaiting).__name__}"
+    return point
+
+
+def stamp_task(loop, coro, **kwargs):
+    """
+    Task factory recording when each task was created (for dump_tasks)
+    """
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    task_started[task] = time.monotonic()
+    return task
+
+
+def dump_tasks():
+    """
+    Log pending asyncio tasks grouped by await point with the age of
+    the oldest task in each group, how long the longest waiting one has
+    been at that await point (since the first dump that saw it there),
+    and task/pool occupancy.
+    Called on SIGUSR2.
+    """
+    now = time.monotonic()
+    groups = {}  # await point: [tasks, oldest age, longest wait]
+    tasks = asyncio.all_tasks()
+    for task in tasks:
+        point = await_point(task)
+        waiting = task_waiting.get(task)
+        if not waiting or waiting[0] != point:  # moved on since last dump
+            waiting = task_waiting[task] = (point, now)
+        group = groups.setdefault(point, [0, 0, 0])
+        group[0] += 1
+        group[1] = max(group[1], now - task_started.get(task, now))
+        group[2] = max(group[2], now - waiting[1])
+    lines = [f"{len(tasks)} pending tasks, num_tasks: {config['num_tasks']}, processing db: {len(processing_db)}, s3: {len(processing_s3)}, large buffers: {config['large_buffers']}/{config['lb_max']}"]
+    if config['db_pool']:
+        lines.append(f"db pool: {config['db_pool'].get_size() - config['db_pool'].get_idle_size()}/{config['db_pool'].get_size()} in use")
+    if config['s3_clients']:
+        lines.append(f"s3 pool: {config['s3_clients'] - len(config['s3_pool'])}/{config['s3_clients']} in use")
+    for point, (count, age, wait) in sorted(
+            groups.items(), key=lambda g: g[1][0], reverse=True):
+        lines.append(f"{count:6d} tasks, oldest {age:7.1f}s old, waiting {wait:7.1f}s: {point}")
+    logging.warning("Task dump:\n" + "\n".join(lines))
+
+
+def start_profiler(path):
+    """
+    Sample the stack of the event loop thread every profile_interval
+    seconds in a background thread
+
+    Args:
+        path: file to write collapsed stacks to (flame graph input)
+    Return:
+        function to stop profiling and write the result
+    """
+    stacks = Counter()
+    stop = threading.Event()
+    thread_id = threading.get_ident()
+
+    def sample():
+        while not stop.wait(config['profile_interval']):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+
+    def stop_profiler():
+        stop.set()
+        thread.join()
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logging.info(f"Wrote {sum(stacks.values())} profile samples to {path}")
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    return stop_profiler
+
+
 async def check_s3():
     """
     Check if can S3 bucket
@@ -359,6 +634,118 @@ async def check_db():
     return False
 
 
+async def create_s3_pool(context_stack):
+    """
+    Create S3 client pool of s3_pool_size clients
+    """
+    for _ in range(config['s3_pool_size']):
+        s3 = await context_stack.enter_async_context(
+            aioboto3.client(
+                's3', endpoint_url=config['s3_endpoint'],
+                verify=False))
+        config['s3_pool'].append(s3)
+        config['s3_clients'] += 1
+
+
+async def lock_catalog(shared):
+    """
+    Take the catalog advisory lock on a dedicated connection
+    Backups take it shared and garbage collection takes it exclusive
+    so that an object isn't deleted while a backup dedupes against it.
+    The lock is released when the returned connection is closed.
+    Return:
+        connection holding the lock or None if it's held by others
+    """
+    db = await asyncpg.connect(
+        config['db_endpoint'], password=config['db_password'],
+        command_timeout=config['db_timeout'])
+    if shared:
+        locked = await db.fetchval(
+            "SELECT pg_try_advisory_lock_shared($1)", CATALOG_LOCK)
+    else:
+        locked = await db.fetchval(
+            "SELECT pg_try_advisory_lock($1)", CATALOG_LOCK)
+    if not locked:
+        await db.close()
+        return None
+    return db
+
+
+async def create_tables(db, timeout=None):
+    """
+    Create database tables and indexes if they don't exist
+    timeout applies to index creation (rebuilding indexes on a large
+    catalog takes longer than db_timeout)
+    """
+    await db.execute("""CREATE TABLE IF NOT EXISTS dirent (
+    id SERIAL PRIMARY KEY,
+    is_deleted integer NOT NULL,
+    type text NOT NULL,
+    fsid text NOT NULL,
+    inode integer NOT NULL,
+    scan_counter bigint NOT NULL
+    );""")
+    await db.execute("CREATE INDEX IF NOT EXISTS Dentidx1 ON dirent(fsid, inode);", timeout=timeout)
+    await db.execute("""CREATE TABLE IF NOT EXISTS version (
+    id SERIAL PRIMARY KEY,
+    is_delmarker integer NOT NULL,
+    name text NOT NULL,
+    size bigint NOT NULL,
+    ctime timestamp NOT NULL,
+    mtime timestamp NOT NULL,
+    atime timestamp NOT NULL,
+    permission integer NOT NULL,
+    uid integer NOT NULL,
+    gid integer NOT NULL,
+    link_path text,
+    xattr text,
+    dirent_id integer NOT NULL,
+    scan_counter bigint NOT NULL,
+    parent_id integer NOT NULL,
+    is_hardlink bool NOT NULL,
+    FOREIGN KEY (dirent_id) REFERENCES dirent (id)
+    );""")
+    await db.execute("CREATE INDEX IF NOT EXISTS Veridx1 ON version(dirent_id);", timeout=timeout)
+    await db.execute("CREATE INDEX IF NOT EXISTS Veridx2 ON version(parent_id);", timeout=timeout)
+    await db.execute("CREATE INDEX IF NOT EXISTS Veridx3 ON version(dirent_id, scan_counter DESC, id DESC);", timeout=timeout)
+    await db.execute("""CREATE TABLE IF NOT EXISTS ver_object (
+    id SERIAL PRIMARY KEY,
+    ver_id integer NOT NULL,
+    object_hash text NOT NULL,
+    FOREIGN KEY (ver_id) REFERENCES version (id)
+    );""")
+    await db.execute("CREATE INDEX IF NOT EXISTS Voidx1 ON ver_object(id, ver_id);", timeout=timeout)
+    await db.execute("CREATE INDEX IF NOT EXISTS Voidx2 ON ver_object(object_hash);", timeout=timeout)
+    await db.execute("""CREATE TABLE IF NOT EXISTS xattr_set (
+    id SERIAL PRIMARY KEY,
+    hash bytea NOT NULL UNIQUE,
+    data bytea NOT NULL
+    );""")
+    # xattr text column is only read for versions backed up before xattr_set
+    await db.execute("ALTER TABLE version ADD COLUMN IF NOT EXISTS xattr_id integer REFERENCES xattr_set (id);")
+    await db.execute("CREATE INDEX IF NOT EXISTS Veridx4 ON version(xattr_id);", timeout=timeout)
+    await db.execute("""CREATE TABLE IF NOT EXISTS scan (
+    scan_counter bigint PRIMARY KEY,
+    start_time timestamp NOT NULL,
+    root_dir text NOT NULL
+    );""")
+    # name lookups for --find; reverse(name) for leading wildcards
+    await db.execute("CREATE INDEX IF NOT EXISTS Veridx5 ON version(name text_pattern_ops);", timeout=timeout)
+    await db.execute("CREATE INDEX IF NOT EXISTS Veridx6 ON version(reverse(name) text_pattern_ops);", timeout=timeout)
+
+
+async def upgrade_tables(db):
+    """
+    Create tables and columns missing in databases of older bus3
+    Cheap when up to date, so that read-only modes don't take the
+    locks create_tables() needs.
+    """
+    up_to_date = await db.fetchval(
+        "SELECT 1 FROM pg_indexes WHERE indexname='veridx6'")
+    if not up_to_date:
+        await create_tables(db, timeout=config['catalog_timeout'])
+
+
 async def async_backup():
     """
     asynchronous backup main task
@@ -374,59 +761,19 @@ async def async_backup():
         config['db_endpoint'], password=config['db_password'],
         command_timeout=config['db_timeout'])
 
+    # hold a shared lock so that garbage collection doesn't run concurrently
+    lock_db = await lock_catalog(shared=True)
+    if not lock_db:
+        logging.error(f"Garbage collection is running.  aborting.")
+        return
+
     # create S3 client pool
     context_stack = contextlib.AsyncExitStack()
-    for _ in range(config['s3_pool_size']):
-        s3 = await context_stack.enter_async_context(
-            aioboto3.client(
-                's3', endpoint_url=config['s3_endpoint'],
-                verify=False))
-        config['s3_pool'].append(s3)
+    await create_s3_pool(context_stack)
 
     async with config['db_pool'].acquire() as db:
         async with db.transaction():
-            await db.execute("""CREATE TABLE IF NOT EXISTS dirent (
-            id SERIAL PRIMARY KEY,
-            is_deleted integer NOT NULL,
-            type text NOT NULL,
-            fsid text NOT NULL,
-            inode integer NOT NULL,
-            scan_counter bigint NOT NULL
-            );""")
-            await db.execute("CREATE INDEX IF NOT EXISTS Dentidx1 ON dirent(fsid, inode);")
-            await db.execute("""CREATE TABLE IF NOT EXISTS version (
-            id SERIAL PRIMARY KEY,
-            is_delmarker integer NOT NULL,
-            name text NOT NULL,
-            size bigint NOT NULL,
-            ctime timestamp NOT NULL,
-            mtime timestamp NOT NULL,
-            atime timestamp NOT NULL,
-            permission integer NOT NULL,
-            uid integer NOT NULL,
-            gid integer NOT NULL,
-            link_path text,
-            xattr text,
-            dirent_id integer NOT NULL,
-            scan_counter bigint NOT NULL,
-            parent_id integer NOT NULL,
-            is_hardlink bool NOT NULL,
-            FOREIGN KEY (dirent_id) REFERENCES dirent (id)
-            );""")
-            await db.execute("CREATE INDEX IF NOT EXISTS Veridx1 ON version(dirent_id);")
-            await db.execute("""CREATE TABLE IF NOT EXISTS ver_object (
-            id SERIAL PRIMARY KEY,
-            ver_id integer NOT NULL,
-            object_hash text NOT NULL,
-            FOREIGN KEY (ver_id) REFERENCES version (id)
-            );""")
-            await db.execute("CREATE INDEX IF NOT EXISTS Voidx1 ON ver_object(id, ver_id);")
-            await db.execute("CREATE INDEX IF NOT EXISTS Voidx2 ON ver_object(object_hash);")
-            await db.execute("""CREATE TABLE IF NOT EXISTS scan (
-            scan_counter bigint PRIMARY KEY,
-            start_time timestamp NOT NULL,
-            root_dir text NOT NULL
-            );""")
+            await create_tables(db)
             maxsc = await db.fetchval("SELECT MAX(scan_counter) FROM dirent;")
             if maxsc or maxsc == 0:
                 config['scan_counter'] = maxsc + 1
@@ -447,27 +794,23 @@ async def async_backup():
         # mark dirent as deleted
         dent_rows = await db.fetch("SELECT id FROM dirent WHERE is_deleted = 0 AND scan_counter < $1", config['scan_counter'])
         for dent_row in dent_rows:
-            logging.info(f"{dent_row}")
+            backup_log.debug("deleted dirent: %s", dent_row[0])
             await db.execute("UPDATE dirent SET is_deleted = 1 WHERE id = $1", dent_row[0])
 
             # Insert delete marker version
             r = await db.fetchrow("SELECT * FROM version WHERE dirent_id=$1 ORDER BY id DESC", dent_row[0])
             if r[1] != 1:  # is_delmarker
-                logging.info(f"delete row - {r}")
+                backup_log.debug("delete marker for version: %s", r[0])
                 await db.execute("INSERT INTO version (is_delmarker, name, size, ctime, mtime, atime, permission, uid, gid, dirent_id, scan_counter, parent_id, is_hardlink) VALUES (1, $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)", r[2], r[3], r[4], r[5], r[6], r[7], r[8], r[9], r[12], config['scan_counter'], r[14], r[15])
 
-    """
-    # backup db file to S3
-    async with aioboto3.client(
-            's3', endpoint_url=config['s3_endpoint'], verify=False) as s3:
-        obj_name = '_'.join(
-            [config['db_endpoint'], str(config['scan_counter'])])
-        await s3.upload_file(
-            config['db_endpoint'], config['s3_bucket'], obj_name)
-    """
+    # backup database (catalog) to S3
+    if config['catalog_export']:
+        await export_catalog(f"{config['scan_counter']:08d}")
+
     await asyncio.sleep(1)
     for s3 in config['s3_pool']:
         await s3.close()
+    await lock_db.close()
 
 
 async def async_list():
@@ -484,48 +827,769 @@ async def async_list():
         command_timeout=config['db_timeout'])
 
     async with config['db_pool'].acquire() as db:
+        await upgrade_tables(db)
         rows = await db.fetch("SELECT * FROM scan")
         print(f"  #: {'date & time'.ljust(19)} backup root directory")
         for row in rows:
             print(f"{row[0]:3d}: {str(row[1])[:19]} {row[2]}")
 
 
-async def async_restoredb():
+async def latest_scan(db):
     """
-    async task to restore database file from S3
-    if an optional negative number is specified, bus3 will restore
-    older versions
+    Return the latest scan counter (0 if there is no backup yet)
     """
-    healthy = await check_s3()
+    val = await db.fetchval("SELECT MAX(scan_counter) FROM scan")
+    return val if val is not None else 0
+
+
+def visible_at(v, scan):
+    """
+    Return SQL condition that version alias v is listed at a scan
+
+    Each scan records every name of a hard link, so the names of a
+    dirent at a scan are its versions recorded in the latest scan (at or
+    before it) that saw the dirent.  A deleted dirent only has a delete
+    marker in that scan.
+
+    Args:
+        v: alias of the version table
+        scan: SQL expression of the scan counter
+    """
+    return f"{v}.is_delmarker=0 AND {v}.scan_counter<={scan} AND NOT EXISTS (SELECT 1 FROM version x WHERE x.dirent_id={v}.dirent_id AND x.scan_counter>{v}.scan_counter AND x.scan_counter<={scan})"
+
+
+def version_windows(max_scan=None):
+    """
+    Return SQL selecting versions with the scans they are superseded at
+
+    A version is listed from its scan until next_scan, the next scan
+    that recorded its dirent (see visible_at()).  File contents (objects)
+    are stored only with the first name of a hard link seen with new
+    contents, so a version with new contents (objects, an empty file or
+    a delete marker) holds them until next_contents, the next such
+    version of the dirent.
+
+    Args:
+        max_scan: optional SQL expression of the latest scan to consider
+    Return:
+        SQL with columns id, dirent_id, scan_counter, size, is_delmarker,
+        new_contents, next_scan and next_contents
+    """
+    where = f"WHERE v.scan_counter<={max_scan}" if max_scan else ""
+    return f"""SELECT id, dirent_id, scan_counter, size, is_delmarker, new_contents,
+    MIN(scan_counter) OVER w AS next_scan,
+    MIN(scan_counter) FILTER (WHERE new_contents) OVER w AS next_contents
+    FROM (SELECT v.id, v.dirent_id, v.scan_counter, v.size, v.is_delmarker,
+          v.is_delmarker=1 OR v.size=0 OR v.id IN (SELECT ver_id FROM ver_object) AS new_contents
+          FROM version v {where}) v
+    WINDOW w AS (PARTITION BY dirent_id ORDER BY scan_counter RANGE BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING)"""
+
+
+async def get_root(db, scan_counter):
+    """
+    Return the backup root directory entry as of scan_counter
+    (None if not backed up yet)
+    """
+    return await db.fetchrow(
+        "SELECT d.id AS dirent_id, v.id AS ver_id, v.name, d.type, v.size, v.mtime, v.permission, v.uid, v.gid, v.link_path, v.scan_counter, v.parent_id, v.is_delmarker FROM version v JOIN dirent d ON d.id=v.dirent_id WHERE v.parent_id=-1 AND d.type='DIRECTORY' AND v.scan_counter<=$1 ORDER BY v.scan_counter DESC, v.id DESC LIMIT 1", scan_counter)
+
+
+async def list_dir(db, dirent_id, scan_counter):
+    """
+    Return children of a directory as of scan_counter
+
+    Args:
+        db: database connection
+        dirent_id: dirent id of the directory
+        scan_counter: point in time (backup history number)
+    Return:
+        list of records (dirent_id, ver_id, name, type, size, mtime,
+        permission, uid, gid, link_path, scan_counter, parent_id,
+        is_delmarker, parent_dirent) sorted by name.  A child is listed
+        once per name (hard links have several) and deleted children are
+        omitted.
+        Results are kept in an LRU cache.
+    """
+    key = (dirent_id, scan_counter)
+    if key in dir_cache:
+        dir_cache.move_to_end(key)
+        return dir_cache[key]
+    # children point to any version of the directory
+    rows = await db.fetch(f"""SELECT d.id AS dirent_id, v.id AS ver_id, v.name, d.type, v.size, v.mtime, v.permission, v.uid, v.gid, v.link_path, v.scan_counter, v.parent_id, v.is_delmarker, p.dirent_id AS parent_dirent
+    FROM version p JOIN version v ON v.parent_id=p.id JOIN dirent d ON d.id=v.dirent_id
+    WHERE p.dirent_id=$1 AND {visible_at('v', '$2')}
+    ORDER BY v.name""", dirent_id, scan_counter)
+    dir_cache[key] = rows
+    if len(dir_cache) > config['dir_cache_size']:
+        dir_cache.popitem(last=False)
+    return rows
+
+
+async def resolve_path(db, path, scan_counter):
+    """
+    Look up a file or directory as of scan_counter
+
+    Args:
+        db: database connection
+        path: path relative to the backup root directory ('' for root)
+        scan_counter: point in time (backup history number)
+    Return:
+        record as returned by list_dir() or None if not found
+    """
+    row = await get_root(db, scan_counter)
+    for name in [p for p in path.split('/') if p]:
+        if not row or row['type'] != Kind.DIRECTORY.name:
+            return None
+        children = await list_dir(db, row['dirent_id'], scan_counter)
+        row = next((c for c in children if c['name'] == name), None)
+    return row
+
+
+async def find_entries(db, pattern, scan_counter, min_size=None,
+                       max_size=None, newer=None, older=None):
+    """
+    Search files and directories as of scan_counter
+
+    Args:
+        db: database connection
+        pattern: name glob (eg, '*.txt')
+        scan_counter: point in time (backup history number)
+        min_size, max_size: optional size range in bytes
+        newer, older: optional mtime range (datetime)
+    Return:
+        list of (path, record) where path is relative to the backup
+        root directory
+    """
+    # narrow down with LIKE in the database, then match the glob exactly
+    def escape(s):
+        return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    like = escape(pattern).replace('*', '%').replace('?', '_')
+    if '[' in like:
+        like = like[:like.index('[')] + '%'
+    # the literal suffix (eg, '.txt' of '*.txt') is looked up with the
+    # reverse(name) index as leading wildcards can't use the name index
+    suffix = pattern[max(pattern.rfind(c) for c in '*?]')+1:]
+    rlike = escape(suffix[::-1]) + '%'
+    # pick hits by name, size and mtime with indexes first, then keep the
+    # ones listed at scan_counter and build their paths from the names of
+    # ancestor directories as of scan_counter (renames)
+    rows = await db.fetch(f"""WITH RECURSIVE hit AS (
+    SELECT v.id AS ver_id, v.dirent_id, d.type, v.name, v.size, v.mtime, v.permission, v.uid, v.gid, v.link_path, v.scan_counter, v.parent_id, v.is_delmarker, p.dirent_id AS parent_dirent
+    FROM version v JOIN dirent d ON d.id=v.dirent_id JOIN version p ON p.id=v.parent_id
+    WHERE v.name LIKE $2 AND reverse(v.name) LIKE $3
+    AND ($4::bigint IS NULL OR v.size>=$4) AND ($5::bigint IS NULL OR v.size<=$5)
+    AND ($6::timestamp IS NULL OR v.mtime>=$6) AND ($7::timestamp IS NULL OR v.mtime<$7)
+    AND {visible_at('v', '$1')}
+    ), anc AS (
+    SELECT h.ver_id AS hit_id, h.parent_dirent AS next_dirent, h.name AS path, false AS at_root FROM hit h
+    UNION ALL
+    SELECT a.hit_id, p.dirent_id, CASE WHEN l.parent_id=-1 THEN a.path ELSE l.name || '/' || a.path END, l.parent_id=-1
+    FROM anc a JOIN version l ON l.dirent_id=a.next_dirent
+    LEFT JOIN version p ON p.id=l.parent_id
+    WHERE NOT a.at_root AND {visible_at('l', '$1')}
+    )
+    SELECT DISTINCT ON (a.path) h.dirent_id, h.ver_id, h.name, h.type, h.size, h.mtime, h.permission, h.uid, h.gid, h.link_path, h.scan_counter, h.parent_id, h.is_delmarker, a.path
+    FROM hit h JOIN anc a ON a.hit_id=h.ver_id AND a.at_root
+    ORDER BY a.path""", scan_counter, like, rlike, min_size, max_size, newer, older)
+    return [(row['path'], row) for row in rows
+            if fnmatch.fnmatchcase(row['name'], pattern)]
+
+
+async def version_history(db, dirent_id):
+    """
+    Return all versions of a file or directory
+
+    Return:
+        list of records (ver_id, scan_counter, start_time, is_delmarker,
+        size, mtime, objects) ordered from oldest to newest
+    """
+    return await db.fetch("SELECT v.id AS ver_id, v.scan_counter, s.start_time, v.is_delmarker, v.size, v.mtime, (SELECT COUNT(*) FROM ver_object o WHERE o.ver_id=v.id) AS objects FROM version v LEFT JOIN scan s ON s.scan_counter=v.scan_counter WHERE v.dirent_id=$1 ORDER BY v.scan_counter, v.id", dirent_id)
+
+
+def format_entry(row, name):
+    """
+    Format a record returned by list_dir()/find_entries() for printing
+    """
+    perm = f"{row['permission'] & 0o7777:04o}"
+    line = f"{row['type'][0].lower()} {perm} {row['uid']:5d} {row['gid']:5d} {row['size']:12d} {str(row['mtime'])[:19]} {name}"
+    if row['type'] == Kind.SYMLINK.name:
+        line += f" -> {row['link_path']}"
+    return line
+
+
+def to_relative(path):
+    """
+    Convert a path to relative from the backup root directory
+    """
+    if config['root_dir'] and path.startswith(config['root_dir']):
+        path = path[len(config['root_dir']):]
+    return path.strip('/')
+
+
+async def async_browse():
+    """
+    asynchronous task to list a directory, find files or
+    show version history of a file as of a backup history number
+    """
+    healthy = await check_db()
     if not healthy:
         return
 
+    # create database connection pool
+    config['db_pool'] = await asyncpg.create_pool(
+        config['db_endpoint'], password=config['db_password'],
+        command_timeout=config['db_timeout'])
+
+    async with config['db_pool'].acquire() as db:
+        await upgrade_tables(db)
+        scan_counter = config['browse_version']
+        if not scan_counter:
+            scan_counter = await latest_scan(db)
+        path = to_relative(config['browse_path'])
+
+        if config['runmode'] == RunMode.FIND:
+            entries = await find_entries(
+                db, config['find_pattern'], scan_counter,
+                config['find_min_size'], config['find_max_size'],
+                config['find_newer'], config['find_older'])
+            for epath, row in entries:
+                print(format_entry(row, epath))
+            return
+
+        row = await resolve_path(db, path, scan_counter)
+        if not row:
+            logging.error(f"No such file or directory: {config['browse_path']}")
+            return
+        if config['runmode'] == RunMode.FILE_HISTORY:
+            rows = await version_history(db, row['dirent_id'])
+            print(f"  #: {'date & time'.ljust(19)} {'size'.rjust(12)} {'mtime'.ljust(19)} objects")
+            for r in rows:
+                if r['is_delmarker']:
+                    print(f"{r['scan_counter']:3d}: {str(r['start_time'])[:19]} (deleted)")
+                    continue
+                print(f"{r['scan_counter']:3d}: {str(r['start_time'])[:19]} {r['size']:12d} {str(r['mtime'])[:19]} {r['objects']}")
+        elif row['type'] != Kind.DIRECTORY.name:
+            print(format_entry(row, row['name']))
+        else:
+            for child in await list_dir(db, row['dirent_id'], scan_counter):
+                print(format_entry(child, child['name']))
+
+
+async def verify_obj(object_hash, size, executor, result):
+    """
+    Verify an S3 object
+
+    Args:
+        object_hash: object key name (sha256 of contents)
+        size: expected object size
+        executor: executor to calculate hash in
+        result: dict of lists 'missing', 'corrupt' and 'error' (couldn't
+                be verified, eg, 403/5xx/timeout) to record keys in
+    """
+    while not config['s3_pool']:
+        await asyncio.sleep(0.5)
+    s3 = config['s3_pool'].pop()
+    try:
+        if config['verify_head_only']:
+            resp = await s3.head_object(
+                Bucket=config['s3_bucket'], Key=object_hash)
+            if resp['ContentLength'] != size:
+                logging.error(
+                    f"Size mismatch: {object_hash} {resp['ContentLength']} != {size}")
+                result['corrupt'].append(object_hash)
+        else:
+            resp = await s3.get_object(
+                Bucket=config['s3_bucket'], Key=object_hash)
+            loop = asyncio.get_running_loop()
+            hash_val = hashlib.sha256()
+            read_size = 0
+            while True:
+                contents = await resp['Body'].read(config['buffersize'])
+                if not contents:
+                    break
+                read_size += len(contents)
+                await loop.run_in_executor(executor, hash_val.update, contents)
+            if read_size != size or hash_val.hexdigest() != object_hash:
+                logging.error(f"Corrupt object: {object_hash}")
+                result['corrupt'].append(object_hash)
+        config['processed_files'] += 1
+        config['processed_size'] += size
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            logging.error(f"Missing object: {object_hash}")
+            result['missing'].append(object_hash)
+        else:
+            logging.error(f"Can't verify {object_hash}: {e}")
+            result['error'].append(object_hash)
+    except Exception as e:  # eg, timeout or connection reset; keep going
+        logging.error(f"Can't verify {object_hash}: {e!r}")
+        result['error'].append(object_hash)
+    finally:
+        config['s3_pool'].append(s3)  # put S3 client back to pool
+        config['num_tasks'] -= 1
+
+
+async def async_verify():
+    """
+    async task to verify S3 objects referenced by a backup
+    """
+    healthy_db = await check_db()
+    healthy_s3 = await check_s3()
+    if not healthy_db or not healthy_s3:
+        logging.info(f"db or s3 not ready {healthy_db} {healthy_s3}")
+        return
+
+    # create database connection pool
+    config['db_pool'] = await asyncpg.create_pool(
+        config['db_endpoint'], password=config['db_password'],
+        command_timeout=config['db_timeout'])
+
+    async with config['db_pool'].acquire() as db:
+        await upgrade_tables(db)
+        scan_counter = config['browse_version']
+        if not scan_counter:
+            scan_counter = await latest_scan(db)
+        # objects holding the contents of files listed at scan_counter
+        # (same windows as gc) with their expected size derived from
+        # file size and chunk position
+        rows = await db.fetch(f"""WITH visible AS (
+        SELECT id, size FROM ({version_windows('$1')}) v
+        WHERE is_delmarker=0 AND new_contents AND next_contents IS NULL)
+        SELECT o.object_hash, MAX(LEAST($2::bigint, v.size - o.idx * $2::bigint)) AS size
+        FROM (SELECT ver_id, object_hash, ROW_NUMBER() OVER (PARTITION BY ver_id ORDER BY id) - 1 AS idx
+              FROM ver_object WHERE ver_id IN (SELECT id FROM visible)) o
+        JOIN visible v ON v.id=o.ver_id
+        GROUP BY o.object_hash""", scan_counter, config['chunksize'])
+    if config['verify_sample'] < 1:
+        rows = [r for r in rows if random.random() < config['verify_sample']]
+    logging.info(f"verifying {len(rows)} objects of scan {scan_counter}")
+
+    context_stack = contextlib.AsyncExitStack()
+    await create_s3_pool(context_stack)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=config['hash_workers'])
+    result = {'missing': [], 'corrupt': [], 'error': []}
+    for row in rows:
+        while config['num_tasks'] >= config['s3_max']:
+            await asyncio.sleep(0.5)
+        config['num_tasks'] += 1
+        task = asyncio.create_task(
+            verify_obj(row[0], row[1], executor, result))
+        task_list.append(task)
+    await asyncio.gather(*task_list)
+    executor.shutdown()
+    await context_stack.aclose()
+
+    print(f"Verified {config['processed_files']} objects of scan {scan_counter}")
+    for key in result['missing']:
+        print(f"missing: {key}")
+    for key in result['corrupt']:
+        print(f"corrupt: {key}")
+    for key in result['error']:
+        print(f"error: {key}")
+    print(f" {len(result['missing'])} missing, {len(result['corrupt'])} corrupt, {len(result['error'])} error")
+
+
+def select_retained(scans, keep_last, keep_daily, keep_weekly):
+    """
+    Select backup history numbers to keep
+
+    Args:
+        scans: list of (scan_counter, start_time)
+        keep_last: keep the last N scans (the latest is always kept)
+        keep_daily: keep the latest scan of each of the last N days
+        keep_weekly: keep the latest scan of each of the last N weeks
+    Return:
+        set of scan counters to keep
+    """
+    scans = sorted(scans, key=lambda s: s[0], reverse=True)
+    retained = {s[0] for s in scans[:max(keep_last, 1)]}
+    periods = ((keep_daily, lambda t: t.date()),
+               (keep_weekly, lambda t: t.isocalendar()[:2]))
+    for num, period in periods:
+        seen = set()
+        for scan_counter, start_time in scans:
+            p = period(start_time)
+            if p in seen:
+                continue
+            if len(seen) >= num:
+                break
+            seen.add(p)
+            retained.add(scan_counter)
+    return retained
+
+
+async def delete_objects(keys):
+    """
+    Delete up to 1000 S3 objects with a DeleteObjects call
+    Return:
+        set of keys that couldn't be deleted
+    """
+    while not config['s3_pool']:
+        await asyncio.sleep(0.5)
+    s3 = config['s3_pool'].pop()
+    try:
+        resp = await s3.delete_objects(
+            Bucket=config['s3_bucket'],
+            Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+    except Exception as e:  # eg, timeout; the objects are only leaked
+        logging.error(f"Can't delete {len(keys)} objects: {e!r}")
+        return set(keys)
+    finally:
+        config['s3_pool'].append(s3)  # put S3 client back to pool
+    errors = resp.get('Errors', [])
+    for err in errors:
+        logging.error(f"Can't delete {err['Key']}: {err.get('Message')}")
+    return {err['Key'] for err in errors}
+
+
+async def async_gc():
+    """
+    async task to expire old backup history and delete S3 objects
+    no longer referenced by any remaining version
+    """
+    healthy_db = await check_db()
+    healthy_s3 = await check_s3()
+    if not healthy_db or not healthy_s3:
+        logging.info(f"db or s3 not ready {healthy_db} {healthy_s3}")
+        return
+
+    # exclusive lock so that no backup dedupes against objects being deleted
+    lock_db = await lock_catalog(shared=False)
+    if not lock_db:
+        logging.error(f"Backup is running.  aborting.")
+        return
+
+    # create database connection pool
+    config['db_pool'] = await asyncpg.create_pool(
+        config['db_endpoint'], password=config['db_password'],
+        command_timeout=config['db_timeout'])
+
+    async with config['db_pool'].acquire() as db:
+        await upgrade_tables(db)
+        scans = await db.fetch("SELECT scan_counter, start_time FROM scan")
+        retained = select_retained(
+            scans, config['keep_last'], config['keep_daily'],
+            config['keep_weekly'])
+        expired = sorted(s[0] for s in scans if s[0] not in retained)
+        logging.info(f"retained scans: {sorted(retained)}")
+        logging.info(f"expired scans: {expired}")
+        if not expired:
+            await lock_db.close()
+            return
+
+        async with db.transaction():
+            await db.execute("CREATE TEMP TABLE gc_keep (scan_counter bigint PRIMARY KEY) ON COMMIT DROP")
+            await db.copy_records_to_table(
+                'gc_keep', records=[(sc,) for sc in retained])
+            # expire a version if no retained scan lists it or needs the
+            # contents (objects) it holds; delete markers are never listed
+            await db.execute(f"""CREATE TEMP TABLE gc_ver ON COMMIT DROP AS
+            SELECT v.id FROM ({version_windows()}) v
+            WHERE NOT EXISTS (SELECT 1 FROM gc_keep k WHERE v.is_delmarker=0 AND k.scan_counter>=v.scan_counter
+                AND (v.next_scan IS NULL OR k.scan_counter<v.next_scan
+                     OR v.new_contents AND (v.next_contents IS NULL OR k.scan_counter<v.next_contents)))""")
+            await db.execute("ALTER TABLE gc_ver ADD PRIMARY KEY (id)")
+            # keep parent directory versions still referenced by children
+            await db.execute("""DELETE FROM gc_ver g USING (
+                WITH RECURSIVE needed(id) AS (
+                    SELECT v.parent_id FROM version v WHERE NOT EXISTS (SELECT 1 FROM gc_ver g WHERE g.id=v.id)
+                    UNION
+                    SELECT p.parent_id FROM needed n JOIN version p ON p.id=n.id)
+                SELECT id FROM needed) n
+            WHERE g.id=n.id""")
+            # keep a delete marker while an earlier version is kept so that
+            # it doesn't show up again in later scans
+            await db.execute("""DELETE FROM gc_ver g USING version m
+            WHERE g.id=m.id AND m.is_delmarker=1 AND EXISTS (
+                SELECT 1 FROM version e WHERE e.dirent_id=m.dirent_id AND e.scan_counter<m.scan_counter
+                AND NOT EXISTS (SELECT 1 FROM gc_ver x WHERE x.id=e.id))""")
+            # object size is derived from file size and chunk position
+            await db.execute("""CREATE TEMP TABLE gc_hash ON COMMIT DROP AS
+            SELECT o.object_hash, MAX(LEAST($1::bigint, v.size - o.idx * $1::bigint)) AS size
+            FROM (SELECT ver_id, object_hash, ROW_NUMBER() OVER (PARTITION BY ver_id ORDER BY id) - 1 AS idx
+                  FROM ver_object WHERE ver_id IN (SELECT id FROM gc_ver)) o
+            JOIN version v ON v.id=o.ver_id
+            GROUP BY o.object_hash""", config['chunksize'])
+            await db.execute("DELETE FROM ver_object o USING gc_ver g WHERE o.ver_id=g.id")
+            await db.execute("DELETE FROM gc_hash h WHERE EXISTS (SELECT 1 FROM ver_object o WHERE o.object_hash=h.object_hash)")
+            num_versions = await db.fetchval("SELECT COUNT(*) FROM gc_ver")
+            await db.execute("DELETE FROM version v USING gc_ver g WHERE v.id=g.id")
+            await db.execute("DELETE FROM dirent d WHERE NOT EXISTS (SELECT 1 FROM version v WHERE v.dirent_id=d.id)")
+            await db.execute("DELETE FROM xattr_set x WHERE NOT EXISTS (SELECT 1 FROM version v WHERE v.xattr_id=x.id)")
+            await db.execute("DELETE FROM scan WHERE scan_counter = ANY($1::bigint[])", expired)
+            hashes = await db.fetch("SELECT object_hash, size FROM gc_hash")
+    logging.info(f"expired {num_versions} versions, {len(hashes)} objects")
+
+    # delete unreferenced objects after commit (a failure only leaks objects)
+    context_stack = contextlib.AsyncExitStack()
+    await create_s3_pool(context_stack)
+    keys = [h[0] for h in hashes]
+    results = await asyncio.gather(
+        *[delete_objects(keys[i:i+1000]) for i in range(0, len(keys), 1000)])
+
+    # older database exports still have the expired versions;
+    # replace them with an export taken under the exclusive lock
+    if config['catalog_export']:
+        old_exports = await list_exports()
+        await export_catalog(f"{max(retained):08d}-gc{datetime.datetime.now():%Y%m%d%H%M%S}")
+        keys = [catalog_key(e, name)
+                for e, names in old_exports.items() for name in names]
+        await asyncio.gather(
+            *[delete_objects(keys[i:i+1000])
+              for i in range(0, len(keys), 1000)])
+    await context_stack.aclose()
+    await lock_db.close()
+
+    failed = set().union(*results)
+    deleted = [h for h in hashes if h[0] not in failed]
+    config['processed_files'] = len(deleted)
+    config['processed_size'] = sum(h[1] for h in deleted)
+    print(f"Expired scans: {' '.join(str(sc) for sc in expired)}")
+    print(f"Deleted {num_versions} versions and {config['processed_files']} objects")
+    print(f"Reclaimed {config['processed_size']/1024/1024:.1f} MB")
+
+
+def catalog_key(export_id, name):
+    """
+    Return S3 key name of a file in a database export
+    (a table export '<table>.gz' or 'manifest')
+    """
+    return f"{config['catalog_prefix']}{export_id}/{name}"
+
+
+async def list_exports():
+    """
+    Return dict of database export id: set of file names in S3
+    """
+    exports = {}
     async with aioboto3.resource(
             's3', endpoint_url=config['s3_endpoint'], verify=False) as s3:
         bucket = await s3.Bucket(config['s3_bucket'])
-        dbbkup_objs = bucket.objects.filter(
-            Prefix=config['db_endpoint'])
-        sorted_dbbkups = []
-        async for name in dbbkup_objs:
-            logging.info(f"name: {str(name)}")
-            name = name.key
-            sorted_dbbkups.append(name[len(config['db_endpoint'])+1:])
-    sorted_dbbkups.sort()
+        async for obj in bucket.objects.filter(
+                Prefix=config['catalog_prefix']):
+            export_id, _, name = \
+                obj.key[len(config['catalog_prefix']):].partition('/')
+            exports.setdefault(export_id, set()).add(name)
+    return exports
+
+
+async def export_table(table, snapshot, export_id):
+    """
+    Export a database table to S3 as a gzipped COPY BINARY stream
+
+    Args:
+        table: table name
+        snapshot: exported snapshot id so that all tables are consistent
+        export_id: database export id (part of the key name)
+    """
+    key = catalog_key(export_id, f"{table}.gz")
+    while not config['s3_pool']:
+        await asyncio.sleep(0.5)
+    s3 = config['s3_pool'].pop()
+    mpu = await s3.create_multipart_upload(
+        Bucket=config['s3_bucket'], Key=key)
+    parts = []
+    buffer = bytearray()
+    comp = zlib.compressobj(config['catalog_compress_level'], wbits=31)
+
+    async def upload_part():
+        resp = await s3.upload_part(
+            Bucket=config['s3_bucket'], Key=key, UploadId=mpu['UploadId'],
+            PartNumber=len(parts)+1, Body=bytes(buffer))
+        parts.append({'PartNumber': len(parts)+1, 'ETag': resp['ETag']})
+        buffer.clear()
+
+    async def write(data):
+        buffer.extend(comp.compress(data))
+        # S3 parts but the last must be >= 5MB; chunksize may be smaller
+        if len(buffer) >= max(config['chunksize'], 8*1024*1024):
+            await upload_part()
+
+    try:
+        async with config['db_pool'].acquire() as db:
+            async with db.transaction(isolation='repeatable_read',
+                                      readonly=True):
+                await db.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+                # the timeout covers the whole COPY including S3 uploads
+                await db.copy_from_table(table, output=write, format='binary',
+                                         timeout=config['catalog_timeout'])
+        buffer.extend(comp.flush())
+        await upload_part()
+        await s3.complete_multipart_upload(
+            Bucket=config['s3_bucket'], Key=key, UploadId=mpu['UploadId'],
+            MultipartUpload={'Parts': parts})
+    except:
+        await s3.abort_multipart_upload(
+            Bucket=config['s3_bucket'], Key=key, UploadId=mpu['UploadId'])
+        raise
+    finally:
+        config['s3_pool'].append(s3)  # put S3 client back to pool
+    logging.info(f"Exported {table}: {key}")
+
+
+async def export_catalog(export_id):
+    """
+    Export all database tables to S3 in parallel from one snapshot
+    The manifest is uploaded last so that only complete exports have it
+    """
+    tables = [table for level in CATALOG_LEVELS for table in level]
+    async with config['db_pool'].acquire() as db:
+        async with db.transaction(isolation='repeatable_read', readonly=True):
+            snapshot = await db.fetchval("SELECT pg_export_snapshot()")
+            # the snapshot is valid while this transaction is open
+            await asyncio.gather(
+                *[export_table(table, snapshot, export_id)
+                  for table in tables])
+    while not config['s3_pool']:
+        await asyncio.sleep(0.5)
+    s3 = config['s3_pool'].pop()
+    try:
+        await s3.put_object(
+            Bucket=config['s3_bucket'], Key=catalog_key(export_id, 'manifest'),
+            Body='\n'.join(tables).encode())
+    finally:
+        config['s3_pool'].append(s3)  # put S3 client back to pool
+    logging.info(f"Exported database: {export_id}")
+
+
+async def import_table(s3, table, export_id):
+    """
+    Load a database table exported by export_table() into the staging
+    schema with COPY
+    """
+    resp = await s3.get_object(Bucket=config['s3_bucket'],
+                               Key=catalog_key(export_id, f"{table}.gz"))
+    decomp = zlib.decompressobj(wbits=31)
+
+    async def read():
+        while True:
+            data = await resp['Body'].read(config['buffersize'])
+            if not data:
+                break
+            data = decomp.decompress(data)
+            if data:
+                yield data
+        data = decomp.flush()
+        if data:
+            yield data
+
+    async with config['db_pool'].acquire() as db:
+        await db.copy_to_table(table, schema_name='bus3_import',
+                               source=read(), format='binary',
+                               timeout=config['catalog_timeout'])
+    logging.info(f"Imported {table}")
+
+
+async def async_restoredb():
+    """
+    async task to restore database from an export in S3
+    if an optional negative number is specified, bus3 will restore
+    older versions
+    Tables are loaded into a staging schema first and swapped in with
+    one transaction, so a failed restore leaves the database as it was
+    """
+    healthy_db = await check_db()
+    healthy_s3 = await check_s3()
+    if not healthy_db or not healthy_s3:
+        logging.info(f"db or s3 not ready {healthy_db} {healthy_s3}")
+        return
+
+    # exclusive lock so that no backup or gc runs while swapping tables
+    lock_db = await lock_catalog(shared=False)
+    if not lock_db:
+        logging.error(f"Backup or gc is running.  aborting.")
+        return
+
+    # exports without manifest are incomplete (e.g. interrupted backup)
+    exports = await list_exports()
+    sorted_dbbkups = sorted(
+        e for e, names in exports.items() if 'manifest' in names)
     logging.info(f"sorted_dbbkups - {sorted_dbbkups}")
     try:
-        file_name = '_'.join([config['db_endpoint'],
-                              sorted_dbbkups[config['dbrestore_rel']-1]])
+        export_id = sorted_dbbkups[config['dbrestore_rel']-1]
     except:
         logging.error(f"No such database backup file version.")
+        await lock_db.close()
         return
+
+    tables = [table for level in CATALOG_LEVELS for table in level]
     async with aioboto3.client(
             's3', endpoint_url=config['s3_endpoint'], verify=False) as s3:
-        try:
-            await s3.download_file(
-                config['s3_bucket'], file_name, config['db_endpoint'])
-            logging.info(f"restored databae: {file_name}")
-        except:
-            logging.error(f"Can't download {file_name}")
+        # make sure that the export is usable before touching the database
+        resp = await s3.get_object(Bucket=config['s3_bucket'],
+                                   Key=catalog_key(export_id, 'manifest'))
+        manifest = (await resp['Body'].read()).decode().split()
+        if sorted(manifest) != sorted(tables):
+            logging.error(f"Unknown tables in database export {export_id}: {manifest}")
+            await lock_db.close()
+            return
+        for table in tables:
+            try:
+                await s3.head_object(
+                    Bucket=config['s3_bucket'],
+                    Key=catalog_key(export_id, f"{table}.gz"))
+            except ClientError as e:
+                logging.error(f"Database export {export_id} is missing {table}: {e}")
+                await lock_db.close()
+                return
+
+        # create database connection pool
+        config['db_pool'] = await asyncpg.create_pool(
+            config['db_endpoint'], password=config['db_password'],
+            command_timeout=config['db_timeout'])
+
+        # staging tables are created as bus3 does and loaded without
+        # foreign keys and secondary indexes
+        async with config['db_pool'].acquire() as db:
+            await db.execute("DROP SCHEMA IF EXISTS bus3_import CASCADE")
+            await db.execute("CREATE SCHEMA bus3_import")
+            async with db.transaction():
+                await db.execute("SET LOCAL search_path TO bus3_import")
+                await create_tables(db)
+                fkeys = await db.fetch("SELECT conrelid::regclass::text AS tbl, conname, pg_get_constraintdef(oid) AS def FROM pg_constraint WHERE contype='f' AND connamespace='bus3_import'::regnamespace")
+                for fk in fkeys:
+                    await db.execute(
+                        f"ALTER TABLE {fk['tbl']} DROP CONSTRAINT {fk['conname']}")
+                for index in ('Dentidx1', 'Veridx1', 'Veridx2', 'Veridx3',
+                              'Veridx4', 'Veridx5', 'Veridx6', 'Voidx1',
+                              'Voidx2'):
+                    await db.execute(f"DROP INDEX {index}")
+        results = await asyncio.gather(
+            *[import_table(s3, table, export_id) for table in tables],
+            return_exceptions=True)
+    errors = [(t, r) for t, r in zip(tables, results)
+              if isinstance(r, Exception)]
+    for table, e in errors:
+        logging.error(f"Can't import {table} from {export_id}: {e!r}")
+    if errors:
+        logging.error(f"Database is unchanged.  aborting.")
+        await lock_db.close()
+        return
+
+    async with config['db_pool'].acquire() as db:
+        # validate foreign keys in one pass each and build indexes
+        async with db.transaction():
+            await db.execute("SET LOCAL search_path TO bus3_import")
+            for table in tables:
+                if table != 'scan':  # no SERIAL id
+                    await db.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 1)) FROM {table}")
+            for fk in fkeys:
+                await db.execute(
+                    f"ALTER TABLE {fk['tbl']} ADD CONSTRAINT {fk['conname']} {fk['def']}",
+                    timeout=config['catalog_timeout'])
+            await create_tables(db, timeout=config['catalog_timeout'])
+        # swap; sequences, constraints and indexes move with the tables
+        async with db.transaction():
+            await db.execute(
+                f"DROP TABLE IF EXISTS {', '.join('public.' + t for t in tables)}")
+            for table in tables:
+                await db.execute(
+                    f"ALTER TABLE bus3_import.{table} SET SCHEMA public")
+        await db.execute("DROP SCHEMA bus3_import")
+        await db.execute("ANALYZE", timeout=config['catalog_timeout'])
+    await lock_db.close()
+    logging.info(f"restored database: {export_id}")
 
 
 async def restore_obj(restore_to, dent_id, ver_id, parent_id, kind):
@@ -538,21 +1602,28 @@ async def restore_obj(restore_to, dent_id, ver_id, parent_id, kind):
         dent_row = await db.fetchrow(
             "SELECT * FROM dirent WHERE id=$1", dent_id)
         ver_row = await db.fetchrow(
-            "SELECT * FROM version WHERE id=$1", ver_id)
+            "SELECT v.*, x.data AS xattr_data FROM version v LEFT JOIN xattr_set x ON x.id=v.xattr_id WHERE v.id=$1", ver_id)
         is_hardlink = ver_row[15]
         process_hardlink = False
         fsid_inode = (dent_row[3], dent_row[4])
         if is_hardlink:
-            logging.info(f"hlink proc: {ver_row[2]} {hardlink_dict}")
+            restore_log.debug("hlink proc: %s (%d hard links)",
+                              ver_row[2], len(hardlink_dict))
             if fsid_inode in hardlink_dict.keys():
                 process_hardlink = True  # skip restore as it's a hard link
             else:
                 hardlink_dict[fsid_inode] = None
         verobjs = await db.fetch(
             "SELECT * FROM ver_object WHERE ver_id=$1 ORDER BY id", ver_id)
+        if kind == Kind.FILE and not verobjs and ver_row[3] > 0:
+            # objects are stored only with the first name of a hard link
+            # seen with new contents; use the contents as of this version
+            verobjs = await db.fetch("SELECT * FROM ver_object WHERE ver_id=(SELECT v.id FROM version v WHERE v.dirent_id=$1 AND v.scan_counter<=$2 AND EXISTS (SELECT 1 FROM ver_object o WHERE o.ver_id=v.id) ORDER BY v.scan_counter DESC, v.id DESC LIMIT 1) ORDER BY id", dent_id, ver_row[13])
         if kind == Kind.DIRECTORY and not is_hardlink:
             # Get children to dispatch
-            children_rows = await db.fetch("SELECT d.id, v.id, v.name, v.parent_id, d.type, v.is_delmarker, MAX(v.scan_counter) FROM dirent d JOIN version v ON d.id=v.dirent_id WHERE (SELECT dirent_id FROM version WHERE id = v.parent_id) = $1 AND v.scan_counter <= $2 GROUP BY v.name, d.id, v.id ORDER BY v.scan_counter DESC", dent_id, config['restore_version'])
+            # same children as --ls; one version per name
+            children_rows = await list_dir(
+                db, dent_id, config['restore_version'])
     processing_db.remove(ver_id)
 
     # download file contents
@@ -626,8 +1697,13 @@ async def restore_obj(restore_to, dent_id, ver_id, parent_id, kind):
         os.utime(fpath, (datetime.datetime.timestamp(ver_row[5]),
                          datetime.datetime.timestamp(ver_row[6])),
                  follow_symlinks=False)
-        xattr_dict = eval(ver_row[11])
-        for k, v in xattr_dict.items():
+        if ver_row['xattr_data']:
+            xattrs = decode_xattrs(ver_row['xattr_data'])
+        elif ver_row[11]:  # backed up before xattr_set
+            xattrs = ast.literal_eval(ver_row[11]).items()
+        else:
+            xattrs = []
+        for k, v in xattrs:
             os.setxattr(fpath, k, v, follow_symlinks=False)
 
         # dispatch children tasks
@@ -638,15 +1714,13 @@ async def restore_obj(restore_to, dent_id, ver_id, parent_id, kind):
 
             # logging.info(f"Will dispatch children: {children_rows}")
             for child_row in children_rows:
-                if child_row[5] == 1:  # is_delmarker
-                    continue
                 while config['num_tasks'] >= config['restore_max']:
                     await asyncio.sleep(1)
-                logging.info(f"Dispatching child: {child_row[2]}")
+                restore_log.debug("Dispatching child: %s", child_row['name'])
                 config['num_tasks'] += 1
                 task = asyncio.create_task(restore_obj(
-                    fpath, child_row[0],
-                    child_row[1], child_row[3], Kind[child_row[4]]))
+                    fpath, child_row['dirent_id'], child_row['ver_id'],
+                    child_row['parent_id'], Kind[child_row['type']]))
                 task_list.append(task)
 
         if is_hardlink:
@@ -683,6 +1757,7 @@ async def async_restore():
     logging.info(f"restore-to: {config['restore_to']}")
 
     async with config['db_pool'].acquire() as db:
+        await upgrade_tables(db)
         restore_target = config['restore_target']
 
         # convert restore_target to relative from root_dir
@@ -696,22 +1771,16 @@ async def async_restore():
         logging.info(
             f"restore-target: {config['restore_target']} ({restore_target})")
 
-        # traverse path
-        plist = restore_target.split('/')
-        parent_id = -1  # root_dir
-        row = await db.fetchrow(
-            "SELECT d.id, v.id, d.type FROM dirent d JOIN version v ON d.id=v.dirent_id WHERE v.parent_id=$1 AND v.scan_counter<=$2 ORDER BY v.scan_counter DESC;", parent_id, config['restore_version'])
-        for pitem in plist[:-1]:
-            parent_id = row[0]
-            row = await db.fetchrow(
-                "SELECT d.id, v.id, d.type FROM dirent d JOIN version v ON d.id=v.dirent_id WHERE v.parent_id=$1 AND v.scan_counter<=$2 ORDER BY v.scan_counter DESC;", parent_id, config['restore_version'])
-            logging.info(f"row tup - {row}")
-            if not row:
-                logging.error(
-                    f"No such file or directory: {config['restore_target']}")
-                return
-        dirent_id, version_id, kind = row
-        kind = Kind[kind]  # convert to Enum.Kind
+        # look up the target with cached directory listings
+        row = await resolve_path(
+            db, restore_target, config['restore_version'])
+        if not row:
+            logging.error(
+                f"No such file or directory: {config['restore_target']}")
+            return
+        dirent_id, version_id, parent_id = \
+            row['dirent_id'], row['ver_id'], row['parent_id']
+        kind = Kind[row['type']]  # convert to Enum.Kind
         #logging.info(f"dent {dirent_id}, ver {version_id}, kind {kind}")
 
         task = asyncio.create_task(
@@ -742,7 +1811,39 @@ def main():
     group.add_argument('-r', '--restore', nargs='*',
                        help='restore all|<directory/file-to-restore> to <directory-to-restore-to>')
     group.add_argument('-R', '--restore_db', nargs='?', const='0',
-                       help='restore database file')
+                       help='restore database from S3 [<num from latest (0,-1..)>]')
+    group.add_argument('-L', '--ls', nargs='*',
+                       help='list [<directory>] [<backup history number>]')
+    group.add_argument('-f', '--find', nargs='+',
+                       help='find <name-glob> [<backup history number>]')
+    group.add_argument('-H', '--history', nargs=1,
+                       help='show version history of <file/directory>')
+    group.add_argument('-g', '--gc', action='store_true',
+                       help='expire old backup history and delete unreferenced objects')
+    group.add_argument('-V', '--verify', nargs='?', const='0',
+                       help='verify S3 objects of a backup [<backup history number>]')
+    parser.add_argument('--min-size', type=int,
+                        help='find files of at least this size in bytes')
+    parser.add_argument('--max-size', type=int,
+                        help='find files of at most this size in bytes')
+    parser.add_argument('--newer', type=datetime.datetime.fromisoformat,
+                        help='find files modified at or after YYYY-MM-DD[ HH:MM:SS]')
+    parser.add_argument('--older', type=datetime.datetime.fromisoformat,
+                        help='find files modified before YYYY-MM-DD[ HH:MM:SS]')
+    parser.add_argument('--keep-last', type=int, default=0,
+                        help='gc: keep the last N backups')
+    parser.add_argument('--keep-daily', type=int, default=0,
+                        help='gc: keep the latest backup of each of the last N days')
+    parser.add_argument('--keep-weekly', type=int, default=0,
+                        help='gc: keep the latest backup of each of the last N weeks')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='log per file/chunk messages')
+    parser.add_argument('--profile', nargs='?', const='bus3.profile',
+                        help='write sampled profile (collapsed stacks) to file')
+    parser.add_argument('--sample', type=float, default=1.0,
+                        help='verify: fraction of objects to verify (0-1)')
+    parser.add_argument('--head-only', action='store_true',
+                        help='verify: only compare object sizes (HEAD)')
     args = parser.parse_args()
     #logging.info(f"{args}, {args.restore_db}")
     if args.backup:
@@ -753,7 +1854,7 @@ def main():
             config['restore_target'] = args.restore[0]
             config['restore_to'] = os.path.abspath(args.restore[1])
             if len(args.restore) == 3:
-                config['restore_version'] = args.restore[2]
+                config['restore_version'] = int(args.restore[2])
             else:
                 config['restore_version'] = sys.maxsize
         else:
@@ -761,7 +1862,7 @@ def main():
                 f"Usage: bus3.py -r all|<directory/file-to-restore> <directory-to-restore-to> [<bakup history number>]")
             return
     elif args.restore_db or args.restore_db == '0':
-        config['runmode'] = RunMode.RESTORE_DB  # restore database file
+        config['runmode'] = RunMode.RESTORE_DB  # restore database
         #logging.info(f"restore_db - {args.restore_db}")
         try:
             config['dbrestore_rel'] = int(args.restore_db)
@@ -771,6 +1872,56 @@ def main():
                 f"Usage: bus3.py --restore_db <num from latest (0,-1..)>")
             return
         #logging.info(f"dbrestore_rel - {config['dbrestore_rel']}")
+    elif args.ls is not None:
+        config['runmode'] = RunMode.LIST_DIR  # list directory
+        try:
+            assert(len(args.ls) <= 2)
+            if args.ls:
+                config['browse_path'] = args.ls[0]
+            if len(args.ls) == 2:
+                config['browse_version'] = int(args.ls[1])
+        except:
+            print(
+                f"Usage: bus3.py --ls [<directory>] [<backup history number>]")
+            return
+    elif args.find:
+        config['runmode'] = RunMode.FIND  # find files
+        try:
+            assert(len(args.find) <= 2)
+            config['find_pattern'] = args.find[0]
+            if len(args.find) == 2:
+                config['browse_version'] = int(args.find[1])
+        except:
+            print(
+                f"Usage: bus3.py --find <name-glob> [<backup history number>] [--min-size N] [--max-size N] [--newer DATE] [--older DATE]")
+            return
+        config['find_min_size'] = args.min_size
+        config['find_max_size'] = args.max_size
+        config['find_newer'] = args.newer
+        config['find_older'] = args.older
+    elif args.history:
+        config['runmode'] = RunMode.FILE_HISTORY  # show version history
+        config['browse_path'] = args.history[0]
+    elif args.gc:
+        config['runmode'] = RunMode.GC  # expire backup history
+        if not (args.keep_last or args.keep_daily or args.keep_weekly):
+            print(
+                f"Usage: bus3.py --gc [--keep-last N] [--keep-daily N] [--keep-weekly N]")
+            return
+        config['keep_last'] = args.keep_last
+        config['keep_daily'] = args.keep_daily
+        config['keep_weekly'] = args.keep_weekly
+    elif args.verify:
+        config['runmode'] = RunMode.VERIFY  # verify S3 objects
+        try:
+            config['browse_version'] = int(args.verify)
+            assert(0 < args.sample <= 1)
+        except:
+            print(
+                f"Usage: bus3.py --verify [<backup history number>] [--sample <0-1>] [--head-only]")
+            return
+        config['verify_sample'] = args.sample
+        config['verify_head_only'] = args.head_only
     else:
         config['runmode'] = RunMode.LIST_HISTORY  # list backup history
 
@@ -782,12 +1933,16 @@ def main():
         loaded = yaml.safe_load(f)
     config.update(loaded['s3_config'])
     config['root_dir'] = loaded['root_dir']
+    listener = setup_logging(loaded.get('log_levels') or {}, args.debug)
 
     loop = asyncio.get_event_loop()
     signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
     for s in signals:
         loop.add_signal_handler(
             s, lambda s=s: asyncio.create_task(shutdown(s, loop)))
+    loop.set_task_factory(stamp_task)
+    loop.add_signal_handler(signal.SIGUSR2, dump_tasks)  # debug stalls
+    stop_profiler = start_profiler(args.profile) if args.profile else None
 
     logging.info(f"runmode: {config['runmode'].name}")
     try:
@@ -797,6 +1952,13 @@ def main():
             task = loop.create_task(async_backup())
         elif config['runmode'] == RunMode.RESTORE_DB:
             task = loop.create_task(async_restoredb())
+        elif config['runmode'] in (RunMode.LIST_DIR, RunMode.FIND,
+                                   RunMode.FILE_HISTORY):
+            task = loop.create_task(async_browse())
+        elif config['runmode'] == RunMode.GC:
+            task = loop.create_task(async_gc())
+        elif config['runmode'] == RunMode.VERIFY:
+            task = loop.create_task(async_verify())
         else:
             task = loop.create_task(async_restore())
         loop.run_until_complete(task)
@@ -805,6 +1967,9 @@ def main():
     finally:
         loop.close()
         logging.info("Completed or gracefully terminated")
+        if stop_profiler:
+            stop_profiler()
+        listener.stop()  # flush queued log records
     config['end_time'] = datetime.datetime.now()
     elapsed_seconds = (config['end_time'] -
                        config['start_time']).total_seconds()